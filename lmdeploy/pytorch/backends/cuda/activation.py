@@ -13,18 +13,10 @@ class TritonSiluAndMulImpl(SiluAndMulImpl):
     def forward(self, x):
         """forward."""
         out = None
-        x_shape = None
-        if x.dim() != 2:
-            x_shape = x.shape
-            x = x.flatten(0, -2)
         if self.inplace:
             out = x.chunk(2, -1)[0]
 
-        out = silu_and_mul(x, out)
-
-        if x_shape is not None:
-            out = out.unflatten(0, x_shape[:-1])
-        return out
+        return silu_and_mul(x, out)
 
 
 class TritonSiluAndMulBuilder(SiluAndMulBuilder):
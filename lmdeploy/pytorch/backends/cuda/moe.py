@@ -69,7 +69,8 @@ class TritonFusedMoEImpl(FusedMoEImpl):
                          topk=self.top_k,
                          expert_offset=expert_offset,
                          num_experts=num_experts,
-                         renormalize=self.renormalize)
+                         renormalize=self.renormalize,
+                         deterministic=torch.are_deterministic_algorithms_enabled())
 
 
 class TritonFusedMoEBuilder(FusedMoEBuilder):
@@ -59,14 +59,25 @@ def _silu_and_mul_kernel(
         out_ptrs += m_id_stride * stride_om
 
 
+def _get_row_stride(x: torch.Tensor):
+    """stride between rows when all dims but the last are treated as one."""
+    if x.dim() == 1:
+        return x.size(-1)
+    for dim in range(x.dim() - 2):
+        assert x.size(dim) == 1 or x.stride(dim) == x.stride(dim + 1) * x.size(dim + 1), (
+            'leading dims of the input can not be flattened without copy.')
+    return x.stride(-2)
+
+
 def silu_and_mul(gate_up: torch.Tensor, out: torch.Tensor = None):
-    """silu and mul."""
-    assert gate_up.dim() == 2
+    """silu and mul.
 
-    M = gate_up.size(0)
+    Leading dims are treated as rows, no reshape is required.
+    """
     N = gate_up.size(-1) // 2
+    M = gate_up.numel() // gate_up.size(-1)
     if out is None:
-        out_shape = (M, N)
+        out_shape = gate_up.shape[:-1] + (N, )
         out = gate_up.new_empty(out_shape)
 
     BLOCK_SIZE_N = triton.next_power_of_2(N)
@@ -85,10 +96,10 @@ def silu_and_mul(gate_up: torch.Tensor, out: torch.Tensor = None):
                                out,
                                N,
                                M,
-                               stride_gum=gate_up.stride(0),
-                               stride_gun=gate_up.stride(1),
-                               stride_om=out.stride(0),
-                               stride_on=out.stride(1),
+                               stride_gum=_get_row_stride(gate_up),
+                               stride_gun=gate_up.stride(-1),
+                               stride_om=_get_row_stride(out),
+                               stride_on=out.stride(-1),
                                BLOCK_SIZE_N=BLOCK_SIZE_N,
                                num_warps=num_warps,
                                num_stages=num_stages)
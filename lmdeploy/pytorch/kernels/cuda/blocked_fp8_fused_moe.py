@@ -15,6 +15,10 @@ def get_cuda_autotune_config():
             'BLOCK_SIZE_M': 128,
             'BLOCK_SIZE_N': 128,
         }, num_stages=3, num_warps=4),
+        triton.Config({
+            'BLOCK_SIZE_M': 64,
+            'BLOCK_SIZE_N': 128,
+        }, num_stages=3, num_warps=4),
     ]
 
 
@@ -1,15 +1,17 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 # modify from: https://github.com/vllm-project/vllm
+import functools
+
 import torch
 import triton
 import triton.language as tl
 
-from .activation import silu_and_mul
 from .triton_utils import get_kernel_meta
+from .utils import get_device_props
 
 
 def get_cuda_autotune_config():
-    return [
+    configs = [
         triton.Config({
             'BLOCK_SIZE_M': 128,
             'BLOCK_SIZE_N': 128,
@@ -34,14 +36,62 @@ def get_cuda_autotune_config():
         },
                       num_stages=4,
                       num_warps=4),
+        # small M, decoding
+        triton.Config({
+            'BLOCK_SIZE_M': 16,
+            'BLOCK_SIZE_N': 64,
+            'BLOCK_SIZE_K': 128,
+            'GROUP_SIZE_M': 1,
+        },
+                      num_stages=4,
+                      num_warps=4),
+        triton.Config({
+            'BLOCK_SIZE_M': 16,
+            'BLOCK_SIZE_N': 128,
+            'BLOCK_SIZE_K': 256,
+            'GROUP_SIZE_M': 1,
+        },
+                      num_stages=3,
+                      num_warps=4),
+        # large M, prefilling
+        triton.Config({
+            'BLOCK_SIZE_M': 64,
+            'BLOCK_SIZE_N': 128,
+            'BLOCK_SIZE_K': 128,
+            'GROUP_SIZE_M': 8,
+        },
+                      num_stages=4,
+                      num_warps=8),
+        triton.Config({
+            'BLOCK_SIZE_M': 128,
+            'BLOCK_SIZE_N': 256,
+            'BLOCK_SIZE_K': 64,
+            'GROUP_SIZE_M': 8,
+        },
+                      num_stages=3,
+                      num_warps=8),
     ]
+    # the grid function only sees the kernel arguments, expose num_warps to size the persistent grid
+    for config in configs:
+        config.kwargs['NUM_WARPS'] = config.num_warps
+    return configs
+
+
+@triton.jit
+def _load_b(ptrs, mask):
+    """load b, weights are shared by all token tiles of the expert, keep them in L2."""
+    if mask is not None:
+        return tl.load(ptrs, mask=mask, other=0.0, cache_modifier='.ca', eviction_policy='evict_last')
+    else:
+        return tl.load(ptrs, cache_modifier='.ca', eviction_policy='evict_last')
 
 
 @triton.autotune(
     configs=get_cuda_autotune_config(),
-    key=['N', 'K', 'M_NP2'],
-    warmup=10,
-    rep=25,
+    key=['N', 'K', 'EXP_M', 'FUSE_SILU_MUL', 'REDUCE_TOPK'],
+    warmup=25,
+    rep=50,
+    reset_to_zero=['C'],
 )
 @triton.jit
 def fused_moe_kernel(
@@ -61,82 +111,189 @@ def fused_moe_kernel(
     stride_bk: tl.constexpr,
     stride_cm: tl.constexpr,
     stride_cn: tl.constexpr,
-    BLOCK_SIZE_M: tl.constexpr,
-    BLOCK_SIZE_N: tl.constexpr,
-    BLOCK_SIZE_K: tl.constexpr,
-    GROUP_SIZE_M: tl.constexpr,
-    M_NP2: tl.constexpr,
+    EXP_M: tl.constexpr,
+    BLOCK_E: tl.constexpr,
+    num_experts: tl.constexpr,
     ENABLE_WEIGHTS: tl.constexpr,
     top_k: tl.constexpr,
     expert_offset: tl.constexpr,
     reindex_a: tl.constexpr,
     reindex_c: tl.constexpr,
+    FUSE_SILU_MUL: tl.constexpr,
+    REDUCE_TOPK: tl.constexpr,
+    # tuned arguments go last, triton<3.2 autotuner indexes the key on the arguments passed at launch
+    BLOCK_SIZE_M: tl.constexpr,
+    BLOCK_SIZE_N: tl.constexpr,
+    BLOCK_SIZE_K: tl.constexpr,
+    GROUP_SIZE_M: tl.constexpr,
+    NUM_WARPS: tl.constexpr,
 ):
-    """fused moe kernel."""
-    exp_id = tl.program_id(1)
-    pid = tl.program_id(0)
-
-    exp_start = tl.load(ExpStart + exp_id + expert_offset)
-    exp_end = tl.load(ExpEnd + exp_id + expert_offset)
-    M = exp_end - exp_start
-    if M <= 0:
-        return
+    """fused moe kernel.
 
-    num_pid_m = tl.cdiv(M_NP2, BLOCK_SIZE_M)
+    A persistent kernel, programs walk the (tile_m, tile_n) work items of the non-empty experts. If FUSE_SILU_MUL, B is
+    [gate, up] along N and C = silu(A @ gate) * (A @ up). If REDUCE_TOPK, C is a float32 [M, N] buffer and the outputs
+    of the topk experts of a token are atomically added to its row.
+    """
+    pid = tl.program_id(0)
+    num_programs = tl.num_programs(0)
+
+    # tiles of all experts, empty experts have no tile
+    offs_e = tl.arange(0, BLOCK_E)
+    mask_e = offs_e < num_experts
+    all_exp_start = tl.load(ExpStart + expert_offset + offs_e, mask=mask_e, other=0, cache_modifier='.ca')
+    all_exp_end = tl.load(ExpEnd + expert_offset + offs_e, mask=mask_e, other=0, cache_modifier='.ca')
+    all_num_pid_m = tl.cdiv((all_exp_end - all_exp_start).to(tl.int32), BLOCK_SIZE_M)
+    all_pid_m_end = tl.cumsum(all_num_pid_m, 0)
+    all_pid_m_start = all_pid_m_end - all_num_pid_m
+
+    num_pid_m = tl.sum(all_num_pid_m, 0)
     num_pid_n = tl.cdiv(N, BLOCK_SIZE_N)
+    num_work_items = num_pid_m * num_pid_n
+
+    for wid in range(pid, num_work_items, num_programs):
+        if GROUP_SIZE_M == 1:
+            pid_m = wid % num_pid_m
+            pid_n = wid // num_pid_m
+        else:
+            num_pid_in_group = GROUP_SIZE_M * num_pid_n
+            group_id = wid // num_pid_in_group
+            first_pid_m = group_id * GROUP_SIZE_M
+            group_size_m = min(num_pid_m - first_pid_m, GROUP_SIZE_M)
+            pid_m = first_pid_m + (wid % group_size_m)
+            pid_n = (wid % num_pid_in_group) // group_size_m
+
+        # locate the expert of the tile
+        exp_id = tl.sum((all_pid_m_end <= pid_m).to(tl.int32), 0)
+        exp_mask = offs_e == exp_id
+        exp_start = tl.sum(tl.where(exp_mask, all_exp_start, 0), 0)
+        exp_end = tl.sum(tl.where(exp_mask, all_exp_end, 0), 0)
+        pid_m = pid_m - tl.sum(tl.where(exp_mask, all_pid_m_start, 0), 0)
+
+        # exp_start is not aligned, only the contiguity of the rows is known
+        offs_sid = tl.max_contiguous(exp_start + pid_m * BLOCK_SIZE_M + tl.arange(0, BLOCK_SIZE_M), BLOCK_SIZE_M)
+        mask_sid = offs_sid < exp_end
+        sid = tl.load(SortedIdx + offs_sid, mask=mask_sid, other=0, cache_modifier='.ca')
+        if ENABLE_WEIGHTS:
+            # issued before the K loop so the load latency is hidden by the gemm
+            weight = tl.load(Weights + sid, mask=mask_sid, other=0.0).to(tl.float32)
+
+        offs_k = tl.max_contiguous(tl.multiple_of(tl.arange(0, BLOCK_SIZE_K), BLOCK_SIZE_K), BLOCK_SIZE_K)
+        if reindex_a:
+            offs_am = sid // top_k
+        else:
+            offs_am = offs_sid
+        a_ptrs = A + (offs_am[:, None] * stride_am + offs_k[None, :] * stride_ak)
+        offs_bn = (pid_n * BLOCK_SIZE_N + tl.arange(0, BLOCK_SIZE_N)) % N
+        offs_bn = tl.max_contiguous(tl.multiple_of(offs_bn, BLOCK_SIZE_N), BLOCK_SIZE_N)
+
+        # deepseek has 160 experts, exp index would overflow int32
+        if num_experts * stride_be >= 2**31:
+            exp_off = stride_be * exp_id.to(tl.int64)
+        else:
+            exp_off = stride_be * exp_id
+        b_ptrs = B + exp_off + (offs_k[:, None] * stride_bk + offs_bn[None, :] * stride_bn)
+
+        accumulator = tl.zeros((BLOCK_SIZE_M, BLOCK_SIZE_N), dtype=tl.float32)
+        if FUSE_SILU_MUL:
+            bu_ptrs = b_ptrs + N * stride_bn
+            accumulator_up = tl.zeros((BLOCK_SIZE_M, BLOCK_SIZE_N), dtype=tl.float32)
+
+        for k in range(0, tl.cdiv(K, BLOCK_SIZE_K)):
+            # skip the K boundary check when K is a multiple of the block
+            if K % BLOCK_SIZE_K == 0:
+                mask_a = mask_sid[:, None]
+                mask_b = None
+            else:
+                mask_k = offs_k < K - k * BLOCK_SIZE_K
+                mask_a = mask_sid[:, None] & mask_k[None, :]
+                mask_b = mask_k[:, None]
+            a = tl.load(a_ptrs, mask=mask_a, other=0.0, eviction_policy='evict_first')
+            b = _load_b(b_ptrs, mask_b)
+            accumulator = tl.dot(a, b, acc=accumulator)
+            a_ptrs += BLOCK_SIZE_K * stride_ak
+            b_ptrs += BLOCK_SIZE_K * stride_bk
+            if FUSE_SILU_MUL:
+                bu = _load_b(bu_ptrs, mask_b)
+                accumulator_up = tl.dot(a, bu, acc=accumulator_up)
+                bu_ptrs += BLOCK_SIZE_K * stride_bk
+
+        if FUSE_SILU_MUL:
+            accumulator = accumulator * tl.sigmoid(accumulator) * accumulator_up
+
+        if ENABLE_WEIGHTS:
+            accumulator = accumulator * weight[:, None]
+
+        if REDUCE_TOPK:
+            # offs_bn wraps around N, wrapped columns must not be added twice
+            mask_bn = pid_n * BLOCK_SIZE_N + tl.arange(0, BLOCK_SIZE_N) < N
+            c_ptrs = C + stride_cm * (sid // top_k)[:, None] + stride_cn * offs_bn[None, :]
+            tl.atomic_add(c_ptrs, accumulator, mask=mask_sid[:, None] & mask_bn[None, :], sem='relaxed')
+        else:
+            c = accumulator.to(A.dtype.element_ty)
+
+            if reindex_c:
+                offs_cm = sid
+            else:
+                offs_cm = offs_sid
+            c_ptrs = C + stride_cm * offs_cm[:, None] + stride_cn * offs_bn[None, :]
+            tl.store(c_ptrs, c, mask=mask_sid[:, None])
+
+
+def _grid_fn(META, len_sorted_idx: int, E: int, N: int, num_sms: int, warps_per_sm: int):
+    """grid of the persistent fused moe kernel."""
+    # each expert has at most one partial tile
+    max_num_pid_m = triton.cdiv(len_sorted_idx, META['BLOCK_SIZE_M']) + E
+    max_work_items = max_num_pid_m * triton.cdiv(N, META['BLOCK_SIZE_N'])
+    # keep as many programs resident as the sm allows, decoding is bounded by the weight loads
+    max_ctas = num_sms * warps_per_sm // META['NUM_WARPS']
+    return (min(max_ctas, max_work_items), )
+
+
+def _get_exp_m_bucket(num_rows: int, num_experts: int):
+    """bucket of the expected rows per expert."""
+    exp_m = triton.cdiv(num_rows, num_experts)
+    for bucket in (16, 64, 256, 1024):
+        if exp_m <= bucket:
+            return bucket
+    return triton.next_power_of_2(exp_m)
+
+
+@functools.lru_cache
+def _get_weight_meta(shape: torch.Size, stride: tuple, device_index: int, fuse_silu_mul: bool):
+    """launch meta that only depends on the weight."""
+    E, N, K = shape
+    if fuse_silu_mul:
+        assert N % 2 == 0
+        N = N // 2
+    stride_be, stride_bn, stride_bk = stride
+    props = get_device_props(device_index)
+    return dict(
+        E=E,
+        N=N,
+        K=K,
+        stride_be=stride_be,
+        stride_bn=stride_bn,
+        stride_bk=stride_bk,
+        BLOCK_E=triton.next_power_of_2(E),
+        num_sms=props['multi_processor_count'],
+        warps_per_sm=props['warps_per_sm'],
+    )
 
-    if GROUP_SIZE_M == 1:
-        pid_m = pid % num_pid_m
-        pid_n = pid // num_pid_m
-    else:
-        num_pid_in_group = GROUP_SIZE_M * num_pid_n
-        group_id = pid // num_pid_in_group
-        first_pid_m = group_id * GROUP_SIZE_M
-        group_size_m = min(num_pid_m - first_pid_m, GROUP_SIZE_M)
-        pid_m = first_pid_m + (pid % group_size_m)
-        pid_n = (pid % num_pid_in_group) // group_size_m
-
-    if pid_m * BLOCK_SIZE_M >= M or pid_n * BLOCK_SIZE_N >= N:
-        return
-
-    offs_sid = exp_start + pid_m * BLOCK_SIZE_M + tl.arange(0, BLOCK_SIZE_M)
-    mask_sid = offs_sid < exp_end
-    sid = tl.load(SortedIdx + offs_sid, mask=mask_sid, other=0)
-
-    offs_k = tl.arange(0, BLOCK_SIZE_K)
-    if reindex_a:
-        offs_am = sid // top_k
-    else:
-        offs_am = offs_sid
-    a_ptrs = A + (offs_am[:, None] * stride_am + offs_k[None, :] * stride_ak)
-    offs_bn = (pid_n * BLOCK_SIZE_N + tl.arange(0, BLOCK_SIZE_N)) % N
-    offs_bn = tl.max_contiguous(tl.multiple_of(offs_bn, BLOCK_SIZE_N), BLOCK_SIZE_N)
-
-    # deepseek has 160 experts, exp index would overflow int32
-    exp_off = stride_be * exp_id.to(tl.int64)
-    b_ptrs = B + exp_off + (offs_k[:, None] * stride_bk + offs_bn[None, :] * stride_bn)
-
-    accumulator = tl.zeros((BLOCK_SIZE_M, BLOCK_SIZE_N), dtype=tl.float32)
-
-    for k in range(0, tl.cdiv(K, BLOCK_SIZE_K)):
-        a = tl.load(a_ptrs, mask=mask_sid[:, None] & (offs_k[None, :] < K - k * BLOCK_SIZE_K), other=0.0)
-        b = tl.load(b_ptrs, mask=offs_k[:, None] < K - k * BLOCK_SIZE_K, other=0.0)
-        accumulator = tl.dot(a, b, acc=accumulator)
-        a_ptrs += BLOCK_SIZE_K * stride_ak
-        b_ptrs += BLOCK_SIZE_K * stride_bk
-
-    if ENABLE_WEIGHTS:
-        weight = tl.load(Weights + sid, mask=mask_sid)
-        accumulator = accumulator * weight[:, None].to(accumulator.dtype)
 
-    c = accumulator.to(A.dtype.element_ty)
+def _flatten_2d(x: torch.Tensor, allow_copy: bool):
+    """flatten x to 2d, return the tensor to launch with and its strides.
 
-    if reindex_c:
-        offs_cm = sid
-    else:
-        offs_cm = offs_sid
-    c_ptrs = C + stride_cm * offs_cm[:, None] + stride_cn * offs_bn[None, :]
-    tl.store(c_ptrs, c, mask=mask_sid[:, None])
+    Contiguous inputs are returned as is. Outputs (`allow_copy=False`) must be viewable as 2d, a copy would not
+    receive the results.
+    """
+    if x.is_contiguous():
+        return x, x.size(-1), 1
+    if not allow_copy:
+        for dim in range(x.dim() - 2):
+            assert x.size(dim) == 1 or x.stride(dim) == x.stride(dim + 1) * x.size(dim + 1), (
+                'leading dims of the output can not be flattened without copy.')
+    x = x.flatten(0, -2)
+    return x, x.stride(0), x.stride(1)
 
 
 def fused_moe_kernel_launcher(
@@ -153,23 +310,33 @@ def fused_moe_kernel_launcher(
     expert_offset: int = 0,
     reindex_a: bool = True,
     reindex_c: bool = True,
+    fuse_silu_mul: bool = False,
+    reduce_topk: bool = False,
 ):
     """fused moe kernel launcher."""
+    if reduce_topk:
+        assert reindex_c and C.dtype == torch.float32
 
     if num_tokens is None:
-        num_tokens = A.size(0)
-    M_NP2 = triton.next_power_of_2(num_tokens)
-    M_NP2 = max(64, M_NP2)
-    E, N, K = B.shape
-
-    def _grid_fn(META):
-        grid = (triton.cdiv(M_NP2, META['BLOCK_SIZE_M']) * triton.cdiv(N, META['BLOCK_SIZE_N']), E)
-        return grid
-
-    A = A.flatten(0, -2)
-    C = C.flatten(0, -2)
+        num_rows = sorted_idx.numel()
+    else:
+        num_rows = num_tokens * top_k
+    # tune on the rows an expert is expected to get, not on the number of tokens
+    EXP_M = _get_exp_m_bucket(num_rows, exp_start.numel())
+    w_meta = _get_weight_meta(B.shape, B.stride(), B.device.index, fuse_silu_mul)
+    E = w_meta['E']
+    N = w_meta['N']
+
+    grid = functools.partial(_grid_fn,
+                             len_sorted_idx=sorted_idx.numel(),
+                             E=E,
+                             N=N,
+                             num_sms=w_meta['num_sms'],
+                             warps_per_sm=w_meta['warps_per_sm'])
+
+    A, stride_am, stride_ak = _flatten_2d(A, allow_copy=True)
+    C, stride_cm, stride_cn = _flatten_2d(C, allow_copy=False)
 
-    grid = _grid_fn
     kernel_meta = get_kernel_meta(A)
     fused_moe_kernel[grid](
         A,
@@ -180,169 +347,234 @@ def fused_moe_kernel_launcher(
         exp_end,
         weights,
         N=N,
-        K=K,
-        stride_am=A.stride(0),
-        stride_ak=A.stride(1),
-        stride_be=B.stride(0),
-        stride_bn=B.stride(1),
-        stride_bk=B.stride(2),
-        stride_cm=C.stride(0),
-        stride_cn=C.stride(1),
+        K=w_meta['K'],
+        stride_am=stride_am,
+        stride_ak=stride_ak,
+        stride_be=w_meta['stride_be'],
+        stride_bn=w_meta['stride_bn'],
+        stride_bk=w_meta['stride_bk'],
+        stride_cm=stride_cm,
+        stride_cn=stride_cn,
         ENABLE_WEIGHTS=enable_weights,
         top_k=top_k,
         expert_offset=expert_offset,
         reindex_a=reindex_a,
         reindex_c=reindex_c,
-        M_NP2=M_NP2,
+        FUSE_SILU_MUL=fuse_silu_mul,
+        REDUCE_TOPK=reduce_topk,
+        EXP_M=EXP_M,
+        BLOCK_E=w_meta['BLOCK_E'],
+        num_experts=E,
         **kernel_meta,
     )
 
 
 @triton.jit
-def _get_exp_mask_kernel(
-    a_ptr,
-    o_mask_ptr,
-    o_k_ptr,
-    stride_a_token: tl.constexpr,
-    stride_a_exp: tl.constexpr,
-    stride_o_exp,
-    stride_o_token: tl.constexpr,
+def _get_exp_count_kernel(
+    topk_ids_ptr,
+    cnt_ptr,
+    stride_ids_token,
+    stride_ids_k: tl.constexpr,
+    stride_cnt_block,
+    len_sorted_idx,
     topk: tl.constexpr,
     num_experts: tl.constexpr,
-    BLOCK_NA: tl.constexpr,
-    BLOCK_NO: tl.constexpr,
+    BLOCK: tl.constexpr,
+    BLOCK_E: tl.constexpr,
 ):
-    token_id = tl.program_id(0)
+    """count experts of each block."""
+    block_id = tl.program_id(0)
 
-    offs_n = tl.arange(0, BLOCK_NA)
-    mask_n = offs_n < topk
-    a_ptrs = a_ptr + token_id * stride_a_token + offs_n * stride_a_exp
-    a = tl.load(a_ptrs, mask=mask_n)
+    offs = block_id * BLOCK + tl.arange(0, BLOCK)
+    mask = offs < len_sorted_idx
+    ids_ptrs = topk_ids_ptr + (offs // topk) * stride_ids_token + (offs % topk) * stride_ids_k
+    ids = tl.load(ids_ptrs, mask=mask, other=num_experts).to(tl.int32)
 
-    # fill zeros
-    offs_no = tl.arange(0, BLOCK_NO)
-    mask_no = offs_no < num_experts
-    o_ptrs = o_mask_ptr + token_id * stride_o_token + offs_no * stride_o_exp
-    tl.store(o_ptrs, 0, mask=mask_no)
+    # masked ids fall into bin `num_experts`, which is never stored
+    cnt = tl.histogram(ids, BLOCK_E)
+    offs_e = tl.arange(0, BLOCK_E)
+    tl.store(cnt_ptr + block_id * stride_cnt_block + offs_e, cnt, mask=offs_e < num_experts)
 
-    # fill a
-    o_ptrs = o_mask_ptr + token_id * stride_o_token + a * stride_o_exp
-    tl.store(o_ptrs, 1, mask=mask_n)
 
-    # fill kid
-    ok_ptrs = o_k_ptr + token_id * stride_o_token + a * stride_o_exp
-    tl.store(ok_ptrs, offs_n, mask=mask_n)
+@triton.jit
+def _get_exp_offset_kernel(
+    cnt_ptr,
+    start_ptr,
+    end_ptr,
+    stride_cnt_block,
+    num_blocks,
+    num_experts: tl.constexpr,
+    BLOCK_B: tl.constexpr,
+    BLOCK_E: tl.constexpr,
+):
+    """exclusive scan of the expert counts.
+
+    Counts in `cnt_ptr` are replaced by the offset of each block inside the expert.
+    """
+    offs_e = tl.arange(0, BLOCK_E)
+    mask_e = offs_e < num_experts
+    offs_b = tl.arange(0, BLOCK_B)
+
+    total = tl.zeros((BLOCK_E, ), dtype=tl.int32)
+    for b_start in range(0, num_blocks, BLOCK_B):
+        cur_b = b_start + offs_b
+        mask = (cur_b < num_blocks)[:, None] & mask_e[None, :]
+        cnt_ptrs = cnt_ptr + cur_b[:, None] * stride_cnt_block + offs_e[None, :]
+        cnt = tl.load(cnt_ptrs, mask=mask, other=0)
+        cum = tl.cumsum(cnt, 0)
+        tl.store(cnt_ptrs, cum - cnt + total[None, :], mask=mask)
+        total += tl.sum(cnt, 0)
+
+    exp_end = tl.cumsum(total, 0)
+    exp_start = exp_end - total
+    tl.store(start_ptr + offs_e, exp_start, mask=mask_e)
+    tl.store(end_ptr + offs_e, exp_end, mask=mask_e)
 
 
-def _get_exp_mask(topk_ids: torch.Tensor, num_experts: int):
-    """get exp mask."""
-    assert topk_ids.dim() == 2
-    M, topk = topk_ids.shape
-    assert topk <= num_experts
+@triton.jit
+def _get_sorted_idx_kernel(
+    topk_ids_ptr,
+    cnt_ptr,
+    start_ptr,
+    out_ptr,
+    stride_ids_token,
+    stride_ids_k: tl.constexpr,
+    stride_cnt_block,
+    len_sorted_idx,
+    topk: tl.constexpr,
+    BLOCK: tl.constexpr,
+):
+    """scatter flattened topk index to the sorted position."""
+    block_id = tl.program_id(0)
 
-    out_mask = topk_ids.new_empty((num_experts, M))
-    out_k = topk_ids.new_empty((num_experts, M))
-    BLOCK_NA = triton.next_power_of_2(topk)
-    BLOCK_NO = triton.next_power_of_2(num_experts)
+    offs_b = tl.arange(0, BLOCK)
+    offs = block_id * BLOCK + offs_b
+    mask = offs < len_sorted_idx
+    ids_ptrs = topk_ids_ptr + (offs // topk) * stride_ids_token + (offs % topk) * stride_ids_k
+    ids = tl.load(ids_ptrs, mask=mask, other=-1).to(tl.int32)
 
-    grid = (M, )
-    _get_exp_mask_kernel[grid](
-        topk_ids,
-        out_mask,
-        out_k,
-        stride_a_token=topk_ids.stride(0),
-        stride_a_exp=topk_ids.stride(1),
-        stride_o_exp=out_mask.stride(0),
-        stride_o_token=out_mask.stride(1),
-        topk=topk,
-        num_experts=num_experts,
-        BLOCK_NA=BLOCK_NA,
-        BLOCK_NO=BLOCK_NO,
-        num_warps=1,
-    )
-    return out_mask, out_k
+    # rank of each index among the previous ones with the same expert, keeps the sort stable
+    same_exp = (ids[:, None] == ids[None, :]) & (offs_b[None, :] < offs_b[:, None])
+    rank = tl.sum(same_exp.to(tl.int32), 1)
+
+    exp_start = tl.load(start_ptr + ids, mask=mask)
+    block_off = tl.load(cnt_ptr + block_id * stride_cnt_block + ids, mask=mask)
+    tl.store(out_ptr + exp_start + block_off + rank, offs, mask=mask)
 
 
 @triton.jit
-def _get_start_end_kernel(
-    exp_cum_ptr,
-    exp_topk_ptr,
-    exp_out_ptr,
+def _get_sorted_idx_single_block_kernel(
+    topk_ids_ptr,
+    out_ptr,
     start_ptr,
     end_ptr,
-    stride_cum_exp,
-    stride_cum_token: tl.constexpr,
-    stride_out: tl.constexpr,
-    num_tokens,
-    num_experts: tl.constexpr,
+    stride_ids_token,
+    stride_ids_k: tl.constexpr,
+    len_sorted_idx,
     topk: tl.constexpr,
-    BLOCK_N: tl.constexpr,
+    num_experts: tl.constexpr,
+    BLOCK: tl.constexpr,
+    BLOCK_E: tl.constexpr,
 ):
-    """get start end kernel."""
-    token_start = tl.program_id(0)
-
-    offs_exp = tl.arange(0, BLOCK_N)
-    off_cum = offs_exp * stride_cum_exp + token_start * stride_cum_token
-    cum_ptrs = exp_cum_ptr + off_cum
-    val_k_ptrs = exp_topk_ptr + off_cum
-
-    mask_exp = offs_exp < num_experts
-
-    # get prev and cur cum
-    token_id = token_start
-    prev_cum_mask = mask_exp
-    if token_start == 0:
-        prev_cum_mask = mask_exp & (tl.arange(0, BLOCK_N) > 0)
-    prev_cum = tl.load(cum_ptrs - stride_cum_token, mask=prev_cum_mask, other=0)
-    cur_cum = tl.load(cum_ptrs, mask=mask_exp)
-
-    # store sorted idx
-    mask_out = mask_exp & (cur_cum > prev_cum)
-    val_k = tl.load(val_k_ptrs, mask=mask_exp)
-    val = token_id * topk + val_k
-    out_ptrs = exp_out_ptr + prev_cum * stride_out
-    tl.store(out_ptrs, val, mask=mask_out)
-
-    # fill start
-    if token_id == 0:
-        cur_start_ptrs = start_ptr + offs_exp
-        tl.store(cur_start_ptrs, prev_cum, mask=mask_exp)
-
-    # fill end
-    if token_id == num_tokens - 1:
-        cur_end_ptrs = end_ptr + offs_exp
-        tl.store(cur_end_ptrs, cur_cum, mask=mask_exp)
-
-
-def get_start_end(exp_cum: torch.Tensor, exp_topk: torch.Tensor, topk: int):
-    """get start end."""
-    num_experts, num_tokens = exp_cum.shape
-
-    start_end = exp_cum.new_empty(2, num_experts)
+    """single block counting sort, histogram, scan and scatter in one program."""
+    offs = tl.arange(0, BLOCK)
+    mask = offs < len_sorted_idx
+    ids_ptrs = topk_ids_ptr + (offs // topk) * stride_ids_token + (offs % topk) * stride_ids_k
+    ids = tl.load(ids_ptrs, mask=mask, other=num_experts).to(tl.int32)
+
+    cnt = tl.histogram(ids, BLOCK_E)
+    exp_end = tl.cumsum(cnt, 0)
+    exp_start = exp_end - cnt
+    offs_e = tl.arange(0, BLOCK_E)
+    mask_e = offs_e < num_experts
+    tl.store(start_ptr + offs_e, exp_start, mask=mask_e)
+    tl.store(end_ptr + offs_e, exp_end, mask=mask_e)
+
+    # sorted position: indices with smaller expert, plus previous indices with the same expert
+    before = (ids[None, :] < ids[:, None]) | ((ids[None, :] == ids[:, None]) & (offs[None, :] < offs[:, None]))
+    pos = tl.sum(before.to(tl.int32), 1)
+    tl.store(out_ptr + pos, offs, mask=mask)
+
+
+def get_start_end(topk_ids: torch.Tensor, num_experts: int):
+    """get sorted idx and start end of each expert.
+
+    A stable counting sort: per block expert histogram, exclusive scan across blocks and experts, then scatter. Inputs
+    that fit in one block are sorted by a single kernel.
+    """
+    num_tokens, topk = topk_ids.shape
+    len_sorted_idx = num_tokens * topk
+
+    start_end = topk_ids.new_empty(2, num_experts)
     exp_start = start_end[0, :]
     exp_end = start_end[1, :]
 
-    out = exp_cum.new_empty((num_tokens * topk))
-
-    num_warps = 1
-
-    BLOCK_N = triton.next_power_of_2(num_experts)
-    grid = (num_tokens, )
+    out = topk_ids.new_empty((len_sorted_idx, ))
+
+    BLOCK = 128
+    BLOCK_B = 16
+    BLOCK_E = triton.next_power_of_2(num_experts + 1)
+
+    if len_sorted_idx <= BLOCK:
+        # decoding, one launch is enough
+        _get_sorted_idx_single_block_kernel[(1, )](
+            topk_ids,
+            out,
+            exp_start,
+            exp_end,
+            stride_ids_token=topk_ids.stride(0),
+            stride_ids_k=topk_ids.stride(1),
+            len_sorted_idx=len_sorted_idx,
+            topk=topk,
+            num_experts=num_experts,
+            BLOCK=max(16, triton.next_power_of_2(len_sorted_idx)),
+            BLOCK_E=BLOCK_E,
+            num_warps=4,
+        )
+        return out, exp_start, exp_end
+
+    num_blocks = triton.cdiv(len_sorted_idx, BLOCK)
+    exp_cnt = topk_ids.new_empty((num_blocks, num_experts), dtype=torch.int32)
+
+    grid = (num_blocks, )
+    _get_exp_count_kernel[grid](
+        topk_ids,
+        exp_cnt,
+        stride_ids_token=topk_ids.stride(0),
+        stride_ids_k=topk_ids.stride(1),
+        stride_cnt_block=exp_cnt.stride(0),
+        len_sorted_idx=len_sorted_idx,
+        topk=topk,
+        num_experts=num_experts,
+        BLOCK=BLOCK,
+        BLOCK_E=BLOCK_E,
+        num_warps=4,
+    )
 
-    _get_start_end_kernel[grid](
-        exp_cum,
-        exp_topk,
-        out,
+    _get_exp_offset_kernel[(1, )](
+        exp_cnt,
         exp_start,
         exp_end,
-        stride_cum_exp=exp_cum.stride(0),
-        stride_cum_token=exp_cum.stride(1),
-        stride_out=out.stride(0),
-        num_tokens=num_tokens,
+        stride_cnt_block=exp_cnt.stride(0),
+        num_blocks=num_blocks,
         num_experts=num_experts,
+        BLOCK_B=BLOCK_B,
+        BLOCK_E=BLOCK_E,
+        num_warps=4,
+    )
+
+    _get_sorted_idx_kernel[grid](
+        topk_ids,
+        exp_cnt,
+        exp_start,
+        out,
+        stride_ids_token=topk_ids.stride(0),
+        stride_ids_k=topk_ids.stride(1),
+        stride_cnt_block=exp_cnt.stride(0),
+        len_sorted_idx=len_sorted_idx,
         topk=topk,
-        BLOCK_N=BLOCK_N,
-        num_warps=num_warps,
+        BLOCK=BLOCK,
+        num_warps=4,
     )
     return out, exp_start, exp_end
 
@@ -350,25 +582,114 @@ def get_start_end(exp_cum: torch.Tensor, exp_topk: torch.Tensor, topk: int):
 def _get_sorted_idx(topk_ids: torch.Tensor, num_experts: int):
     """get sorted idx."""
     assert topk_ids.dim() == 2
-    _, topk = topk_ids.shape
-
-    # get expert mask   (num_experts, num_tokens)
-    exp_mask, exp_topk = _get_exp_mask(topk_ids, num_experts)
-    # get cumsum   (num_experts, num_tokens)
-    exp_cum = exp_mask.flatten().cumsum(0).view_as(exp_mask)
 
     # get sort idx and start/end
-    sorted_idx, start, end = get_start_end(exp_cum, exp_topk, topk)
+    sorted_idx, start, end = get_start_end(topk_ids, num_experts)
 
     return sorted_idx, start, end
 
 
+@triton.jit
+def _gather_a_kernel(
+    A,
+    SortedIdx,
+    Out,
+    len_sorted_idx,
+    K: tl.constexpr,
+    stride_am,
+    stride_ak: tl.constexpr,
+    stride_om,
+    stride_ok: tl.constexpr,
+    top_k: tl.constexpr,
+    BLOCK_M: tl.constexpr,
+    BLOCK_K: tl.constexpr,
+):
+    """gather rows of A in sorted order."""
+    pid_m = tl.program_id(0)
+    pid_k = tl.program_id(1)
+
+    offs_m = pid_m * BLOCK_M + tl.arange(0, BLOCK_M)
+    mask_m = offs_m < len_sorted_idx
+    sid = tl.load(SortedIdx + offs_m, mask=mask_m, other=0)
+    offs_am = sid // top_k
+
+    offs_k = pid_k * BLOCK_K + tl.arange(0, BLOCK_K)
+    mask = mask_m[:, None] & (offs_k[None, :] < K)
+    a = tl.load(A + offs_am[:, None] * stride_am + offs_k[None, :] * stride_ak, mask=mask)
+    tl.store(Out + offs_m[:, None] * stride_om + offs_k[None, :] * stride_ok, a, mask=mask)
+
+
+# 32MB of 16-bit hidden states
+_GATHER_A_MAX_NUMEL = 1 << 24
+
+
+def _gather_a(A: torch.Tensor, sorted_idx: torch.Tensor, top_k: int):
+    """gather A to [len_sorted_idx, K], row i is A[sorted_idx[i] // top_k]."""
+    A = A.flatten(0, -2)
+    len_sorted_idx = sorted_idx.numel()
+    K = A.size(1)
+    out = A.new_empty((len_sorted_idx, K))
+
+    BLOCK_M = 16
+    BLOCK_K = min(512, triton.next_power_of_2(K))
+    grid = (triton.cdiv(len_sorted_idx, BLOCK_M), triton.cdiv(K, BLOCK_K))
+    _gather_a_kernel[grid](
+        A,
+        sorted_idx,
+        out,
+        len_sorted_idx,
+        K=K,
+        stride_am=A.stride(0),
+        stride_ak=A.stride(1),
+        stride_om=out.stride(0),
+        stride_ok=out.stride(1),
+        top_k=top_k,
+        BLOCK_M=BLOCK_M,
+        BLOCK_K=BLOCK_K,
+        num_warps=4,
+    )
+    return out
+
+
+@triton.jit
+def _renormalize_kernel(
+    Weights,
+    Out,
+    topk: tl.constexpr,
+    stride_wm,
+    stride_wk,
+    BLOCK: tl.constexpr,
+):
+    """renormalize kernel."""
+    pid = tl.program_id(0)
+    offs = tl.arange(0, BLOCK)
+    mask = offs < topk
+
+    w = tl.load(Weights + pid * stride_wm + offs * stride_wk, mask=mask, other=0.0).to(tl.float32)
+    w = w / tl.sum(w)
+    tl.store(Out + pid * topk + offs, w.to(Out.dtype.element_ty), mask=mask)
+
+
 def _renormalize(topk_weights: torch.Tensor, renormalize: bool):
-    if renormalize:
-        topk_weights = topk_weights / topk_weights.sum(dim=-1, keepdim=True)
-    if not topk_weights.is_contiguous():
-        topk_weights = topk_weights.contiguous()
-    return topk_weights
+    if not renormalize:
+        if not topk_weights.is_contiguous():
+            topk_weights = topk_weights.contiguous()
+        return topk_weights
+
+    M, topk = topk_weights.shape
+    out = torch.empty((M, topk), dtype=topk_weights.dtype, device=topk_weights.device)
+    if M == 0:
+        return out
+    _renormalize_kernel[(M, )](
+        topk_weights,
+        out,
+        topk=topk,
+        stride_wm=topk_weights.stride(0),
+        stride_wk=topk_weights.stride(1),
+        BLOCK=triton.next_power_of_2(topk),
+        num_warps=1,
+    )
+    return out
 
 
 def _make_intermediate(shape: tuple, dtype: torch.dtype, device: torch.device, zeros: bool):
@@ -387,10 +708,16 @@ def fused_moe(hidden_states: torch.Tensor,
               topk: int,
               expert_offset: int = 0,
               num_experts: int = None,
-              renormalize: bool = False) -> torch.Tensor:
-    """fused moe."""
+              renormalize: bool = False,
+              deterministic: bool = False) -> torch.Tensor:
+    """fused moe.
+
+    The topk outputs of a token are atomically added to its row in the down projection, the order of the additions
+    depends on the schedule and the result is not bitwise reproducible. Set `deterministic` to write the topk outputs
+    to a [M, topk, D] buffer and sum them in a separate pass instead.
+    """
     M = hidden_states.size(0)
-    E, N, _ = w1.shape
+    E, N, K = w1.shape
     if num_experts is None:
         num_experts = E
     full_exp = num_experts == E
@@ -398,15 +725,21 @@ def fused_moe(hidden_states: torch.Tensor,
     topk_weights = _renormalize(topk_weights, renormalize)
     sorted_idx, exp_start, exp_end = _get_sorted_idx(topk_ids, num_experts)
 
-    intermediate_cache1 = _make_intermediate((M, topk, N),
-                                             dtype=hidden_states.dtype,
-                                             device=hidden_states.device,
-                                             zeros=not full_exp)
-    # gate and up
+    # rows follow sorted_idx, rows of the experts outside this rank are never read
+    gate_cache = hidden_states.new_empty((sorted_idx.numel(), N // 2))
+    # tokens are shared by topk experts, gather them once so the gemm reads A contiguously.
+    # The copy holds topk rows per token, skip it when it is large or most rows belong to other ranks.
+    gather_a = topk >= 4 and full_exp and sorted_idx.numel() * K <= _GATHER_A_MAX_NUMEL
+    if gather_a:
+        gate_up_input = _gather_a(hidden_states, sorted_idx, topk)
+    else:
+        gate_up_input = hidden_states
+
+    # gate and up, activate
     fused_moe_kernel_launcher(
-        hidden_states,
+        gate_up_input,
         w1,
-        intermediate_cache1,
+        gate_cache,
         sorted_idx=sorted_idx,
         exp_start=exp_start,
         exp_end=exp_end,
@@ -415,36 +748,53 @@ def fused_moe(hidden_states: torch.Tensor,
         top_k=topk,
         num_tokens=M,
         expert_offset=expert_offset,
-        reindex_a=True,
+        reindex_a=not gather_a,
         reindex_c=False,
+        fuse_silu_mul=True,
     )
-
-    # activate
-    unflat_size = intermediate_cache1.shape[:-1]
-    intermediate_cache1 = intermediate_cache1.flatten(0, -2)
-    gate_cache = silu_and_mul(intermediate_cache1)
-    gate_cache = gate_cache.unflatten(0, unflat_size)
-
-    intermediate_cache2 = _make_intermediate((M, topk, w2.shape[1]),
-                                             dtype=hidden_states.dtype,
-                                             device=hidden_states.device,
-                                             zeros=not full_exp)
-    # down
+    del gate_up_input
+
+    if deterministic:
+        # down, topk outputs are summed in a fixed order
+        intermediate_cache2 = _make_intermediate((M, topk, w2.shape[1]),
+                                                 dtype=hidden_states.dtype,
+                                                 device=hidden_states.device,
+                                                 zeros=not full_exp)
+        fused_moe_kernel_launcher(
+            gate_cache,
+            w2,
+            intermediate_cache2,
+            sorted_idx=sorted_idx,
+            exp_start=exp_start,
+            exp_end=exp_end,
+            weights=topk_weights,
+            enable_weights=True,
+            top_k=1,
+            num_tokens=M,
+            expert_offset=expert_offset,
+            reindex_a=False,
+            reindex_c=True,
+        )
+        return intermediate_cache2.sum(dim=1)
+
+    # down, reduce topk
+    output = hidden_states.new_zeros((M, w2.shape[1]), dtype=torch.float32)
     fused_moe_kernel_launcher(
         gate_cache,
         w2,
-        intermediate_cache2,
+        output,
         sorted_idx=sorted_idx,
         exp_start=exp_start,
         exp_end=exp_end,
         weights=topk_weights,
         enable_weights=True,
-        top_k=1,
+        top_k=topk,
         num_tokens=M,
         expert_offset=expert_offset,
         reindex_a=False,
         reindex_c=True,
+        reduce_topk=True,
     )
 
-    ret = intermediate_cache2.sum(dim=1)
+    ret = output.to(hidden_states.dtype)
     return ret
@@ -276,11 +276,8 @@ def fused_moe_w8a8(input: torch.Tensor,
     )
 
     # activate
-    unflat_size = intermediate_cache1.shape[:-1]
-    intermediate_cache1 = intermediate_cache1.flatten(0, -2)
     gate_cache = silu_and_mul(intermediate_cache1)
     del intermediate_cache1
-    gate_cache = gate_cache.unflatten(0, unflat_size)
     gate_cache, gate_scale = per_token_quant_int8(gate_cache, 1e-7, quant_dtype=quant_dtype)
 
     intermediate_cache2 = _make_intermediate((M, topk, w2.shape[1]), dtype=out_dtype, device=device, zeros=not full_exp)
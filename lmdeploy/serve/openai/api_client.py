@@ -1,40 +1,108 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import asyncio
+import functools
+import inspect
 import json
-from typing import Any, Dict, Iterable, List, Optional, Union
+import threading
+from typing import Any, AsyncIterator, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
 
 import requests
 
 from lmdeploy.utils import get_logger
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
-def get_model_list(api_url: str, headers: dict = None):
+logger = get_logger('lmdeploy')
+
+
+def get_model_list(api_url: str, headers: dict = None, session: Optional[requests.Session] = None):
     """Get model list from api server."""
-    response = requests.get(api_url, headers=headers)
-    logger = get_logger('lmdeploy')
+    if session is None:
+        session = requests
+    response = session.get(api_url, headers=headers)
     if not response.ok:
-        logger.error(f'Failed to get the model list: {api_url}'
-                     'returns {response.status_code}')
+        logger.error(f'Failed to get the model list: {api_url} '
+                     f'returns {response.status_code}')
         return None
-    elif not hasattr(response, 'text'):
-        logger.warning('Failed to get the model list.')
-        return None
-    else:
-        model_list = response.json()
-        model_list = model_list.pop('data', [])
-        return [item['id'] for item in model_list]
+    model_list = _json_loads(response.content)
+    model_list = model_list.pop('data', [])
+    return [item['id'] for item in model_list]
 
 
 def json_loads(content):
-    """Loads content to json format."""
+    """Loads content to json format, `content` can be str or bytes."""
     try:
-        content = json.loads(content)
+        content = _json_loads(content)
         return content
-    except:  # noqa
-        logger = get_logger('lmdeploy')
+    except (ValueError, TypeError):
+        # orjson.JSONDecodeError and json.JSONDecodeError are ValueError
         logger.warning(f'weird json content {content}')
         return ''
 
 
+def _iter_lines(response: requests.Response, chunk_size: int = 8192):
+    """Split the response body into lines.
+
+    Only the unfinished tail is kept between reads, the buffer is never
+    rescanned.
+    """
+    buf = bytearray()
+    for part in response.iter_content(chunk_size=chunk_size):
+        buf.extend(part)
+        *lines, buf = buf.split(b'\n')
+        for line in lines:
+            yield bytes(line)
+    if buf:
+        yield bytes(buf)
+
+
+def _import_aiohttp():
+    """Import aiohttp for the async methods of APIClient."""
+    try:
+        import aiohttp
+    except ImportError as e:
+        raise ImportError('The async methods of APIClient require aiohttp, '
+                          'please install it by `pip install aiohttp`.') from e
+    return aiohttp
+
+
+@functools.lru_cache
+def _get_signature(func) -> inspect.Signature:
+    """Signature of an APIClient method without `self`."""
+    sig = inspect.signature(func)
+    return sig.replace(parameters=list(sig.parameters.values())[1:])
+
+
+class _Endpoints(NamedTuple):
+    chat_intractive_v1_url: str
+    chat_completions_v1_url: str
+    completions_v1_url: str
+    models_v1_url: str
+    encode_v1_url: str
+
+
+@functools.lru_cache
+def _get_endpoints(api_server_url: str) -> _Endpoints:
+    """Endpoint urls of an api server, shared by the clients of the same
+    server."""
+    return _Endpoints(
+        chat_intractive_v1_url=f'{api_server_url}/v1/chat/interactive',
+        chat_completions_v1_url=f'{api_server_url}/v1/chat/completions',
+        completions_v1_url=f'{api_server_url}/v1/completions',
+        models_v1_url=f'{api_server_url}/v1/models',
+        encode_v1_url=f'{api_server_url}/v1/encode',
+    )
+
+
+def _is_sse(response) -> bool:
+    """Whether a streamed response is server-sent events."""
+    return 'application/x-ndjson' not in response.headers.get('content-type', '')
+
+
 class APIClient:
     """Chatbot for LLaMA series models with turbomind as inference engine.
 
@@ -47,23 +115,34 @@ class APIClient:
 
     def __init__(self, api_server_url: str, api_key: Optional[str] = None, **kwargs):
         self.api_server_url = api_server_url
-        self.chat_intractive_v1_url = f'{api_server_url}/v1/chat/interactive'
-        self.chat_completions_v1_url = f'{api_server_url}/v1/chat/completions'
-        self.completions_v1_url = f'{api_server_url}/v1/completions'
-        self.models_v1_url = f'{api_server_url}/v1/models'
-        self.encode_v1_url = f'{api_server_url}/v1/encode'
-        self._available_models = None
+        endpoints = _get_endpoints(api_server_url)
+        self.chat_intractive_v1_url = endpoints.chat_intractive_v1_url
+        self.chat_completions_v1_url = endpoints.chat_completions_v1_url
+        self.completions_v1_url = endpoints.completions_v1_url
+        self.models_v1_url = endpoints.models_v1_url
+        self.encode_v1_url = endpoints.encode_v1_url
         self.api_key = api_key
-        self.headers = {'content-type': 'application/json'}
+        # streamed responses are newline delimited json if the server supports it, sse otherwise
+        self.headers = {'content-type': 'application/json', 'accept': 'application/x-ndjson, text/event-stream'}
         if api_key is not None:
             self.headers['Authorization'] = f'Bearer {api_key}'
+        # keep-alive connections shared by all requests of the client
+        self._session = requests.Session()
+        self._session.headers.update(self.headers)
+        # created on first async call, it is bound to the event loop it was created in
+        self._aiosession = None
+        self._aioloop = None
+        # only a successful model list is cached, a failed lookup is retried
+        self._available_models = None
+        self._available_models_lock = threading.Lock()
 
     @property
     def available_models(self):
         """Show available models."""
-        if self._available_models is not None:
-            return self._available_models
-        self._available_models = get_model_list(self.models_v1_url, headers=self.headers)
+        if self._available_models is None:
+            with self._available_models_lock:
+                if self._available_models is None:
+                    self._available_models = get_model_list(self.models_v1_url, session=self._session)
         return self._available_models
 
     def encode(self,
@@ -79,14 +158,33 @@ class APIClient:
                 when it is not. Default to True.
         Return: (input_ids, length)
         """
-        response = requests.post(self.encode_v1_url,
-                                 headers=self.headers,
-                                 json=dict(input=input, do_preprocess=do_preprocess, add_bos=add_bos),
-                                 stream=False)
-        if hasattr(response, 'text'):
-            output = json_loads(response.text)
-            return output['input_ids'], output['length']
-        return None, None
+        response = self._session.post(self.encode_v1_url,
+                                      json=dict(input=input, do_preprocess=do_preprocess, add_bos=add_bos),
+                                      stream=False)
+        if not response.ok:
+            return None, None
+        output = json_loads(response.content)
+        return output['input_ids'], output['length']
+
+    def encode_many(self,
+                    inputs: List[str],
+                    do_preprocess: Optional[bool] = False,
+                    add_bos: Optional[bool] = True) -> List[Tuple[List[int], int]]:
+        """Encode a batch of prompts with a single request.
+
+        Args:
+            inputs: the prompts to be encoded.
+            do_preprocess: whether do preprocess or not. Default to False.
+            add_bos: True when it is the beginning of a conversation. False
+                when it is not. Default to True.
+        Return: a list of (input_ids, length), one for each prompt
+        """
+        if len(inputs) == 0:
+            return []
+        input_ids, length = self.encode(list(inputs), do_preprocess=do_preprocess, add_bos=add_bos)
+        if input_ids is None:
+            return [(None, None)] * len(inputs)
+        return list(zip(input_ids, length))
 
     def chat_completions_v1(self,
                             model: str,
@@ -151,22 +249,33 @@ class APIClient:
         Yields:
             json objects in openai formats
         """
-        pload = {k: v for k, v in locals().copy().items() if k[:2] != '__' and k not in ['self']}
-        response = requests.post(self.chat_completions_v1_url, headers=self.headers, json=pload, stream=stream)
-        for chunk in response.iter_lines(chunk_size=8192, decode_unicode=False, delimiter=b'\n'):
-            if chunk:
-                if stream:
-                    decoded = chunk.decode('utf-8')
-                    if decoded == 'data: [DONE]':
-                        continue
-                    if decoded[:6] == 'data: ':
-                        decoded = decoded[6:]
-                    output = json_loads(decoded)
-                    yield output
-                else:
-                    decoded = chunk.decode('utf-8')
-                    output = json_loads(decoded)
-                    yield output
+        pload = {
+            'model': model,
+            'messages': messages,
+            'temperature': temperature,
+            'top_p': top_p,
+            'logprobs': logprobs,
+            'top_logprobs': top_logprobs,
+            'n': n,
+            'max_tokens': max_tokens,
+            'stop': stop,
+            'stream': stream,
+            'presence_penalty': presence_penalty,
+            'frequency_penalty': frequency_penalty,
+            'user': user,
+            'repetition_penalty': repetition_penalty,
+            'ignore_eos': ignore_eos,
+            'skip_special_tokens': skip_special_tokens,
+            'spaces_between_special_tokens': spaces_between_special_tokens,
+            'top_k': top_k,
+            'min_new_tokens': min_new_tokens,
+            'min_p': min_p,
+            'logit_bias': logit_bias,
+            'stream_options': stream_options,
+        }
+        pload.update(kwargs)
+        response = self._session.post(self.chat_completions_v1_url, json=pload, stream=stream)
+        yield from self._yield_sse(response, sse=stream and _is_sse(response))
 
     def chat_interactive_v1(self,
                             prompt: Union[str, List[Dict[str, str]]],
@@ -224,13 +333,25 @@ class APIClient:
             json objects consist of text, tokens, input_tokens,
                 history_tokens, finish_reason
         """
-        pload = {k: v for k, v in locals().copy().items() if k[:2] != '__' and k not in ['self']}
-        response = requests.post(self.chat_intractive_v1_url, headers=self.headers, json=pload, stream=stream)
-        for chunk in response.iter_lines(chunk_size=8192, decode_unicode=False, delimiter=b'\n'):
-            if chunk:
-                decoded = chunk.decode('utf-8')
-                output = json_loads(decoded)
-                yield output
+        pload = {
+            'prompt': prompt,
+            'image_url': image_url,
+            'session_id': session_id,
+            'interactive_mode': interactive_mode,
+            'stream': stream,
+            'stop': stop,
+            'request_output_len': request_output_len,
+            'top_p': top_p,
+            'top_k': top_k,
+            'temperature': temperature,
+            'repetition_penalty': repetition_penalty,
+            'ignore_eos': ignore_eos,
+            'skip_special_tokens': skip_special_tokens,
+            'adapter_name': adapter_name,
+        }
+        pload.update(kwargs)
+        response = self._session.post(self.chat_intractive_v1_url, json=pload, stream=stream)
+        yield from self._yield_sse(response, sse=False)
 
     def completions_v1(
             self,
@@ -286,22 +407,135 @@ class APIClient:
         Yields:
             json objects in openai formats
         """
-        pload = {k: v for k, v in locals().copy().items() if k[:2] != '__' and k not in ['self']}
-        response = requests.post(self.completions_v1_url, headers=self.headers, json=pload, stream=stream)
-        for chunk in response.iter_lines(chunk_size=8192, decode_unicode=False, delimiter=b'\n'):
-            if chunk:
-                if stream:
-                    decoded = chunk.decode('utf-8')
-                    if decoded == 'data: [DONE]':
-                        continue
-                    if decoded[:6] == 'data: ':
-                        decoded = decoded[6:]
-                    output = json_loads(decoded)
-                    yield output
-                else:
-                    decoded = chunk.decode('utf-8')
-                    output = json_loads(decoded)
+        pload = {
+            'model': model,
+            'prompt': prompt,
+            'suffix': suffix,
+            'temperature': temperature,
+            'n': n,
+            'max_tokens': max_tokens,
+            'stream': stream,
+            'stop': stop,
+            'top_p': top_p,
+            'top_k': top_k,
+            'user': user,
+            'repetition_penalty': repetition_penalty,
+            'ignore_eos': ignore_eos,
+            'skip_special_tokens': skip_special_tokens,
+            'spaces_between_special_tokens': spaces_between_special_tokens,
+            'stream_options': stream_options,
+        }
+        pload.update(kwargs)
+        response = self._session.post(self.completions_v1_url, json=pload, stream=stream)
+        yield from self._yield_sse(response, sse=stream and _is_sse(response))
+
+    @staticmethod
+    def _yield_sse(response: requests.Response, sse: bool):
+        """Yield the json outputs of a response, strip the server-sent events
+        framing if `sse`."""
+        for chunk in _iter_lines(response):
+            if not chunk:
+                continue
+            if sse:
+                if chunk == b'data: [DONE]':
+                    continue
+                if chunk.startswith(b'data: '):
+                    chunk = chunk[6:]
+            yield json_loads(chunk)
+
+    @staticmethod
+    def _bind_pload(func, *args, **kwargs):
+        """Build the request body with the signature and defaults of the
+        method `func`."""
+        bound = _get_signature(func.__func__).bind(*args, **kwargs)
+        bound.apply_defaults()
+        pload = dict(bound.arguments)
+        pload.update(pload.pop('kwargs', {}))
+        return pload
+
+    def _get_aiosession(self):
+        """Get the shared aiohttp session, None if it belongs to another event
+        loop."""
+        aiohttp = _import_aiohttp()
+        loop = asyncio.get_running_loop()
+        if self._aiosession is None or self._aiosession.closed:
+            self._aiosession = aiohttp.ClientSession(headers=self.headers)
+            self._aioloop = loop
+        if self._aioloop is not loop:
+            return None
+        return self._aiosession
+
+    async def _apost(self, url: str, pload: Dict, sse: bool) -> AsyncIterator[Dict]:
+        """Post a request with aiohttp and yield the json outputs."""
+        session = self._get_aiosession()
+        if session is None:
+            # the shared session is bound to another event loop, e.g. of a previous `asyncio.run`
+            async with _import_aiohttp().ClientSession(headers=self.headers) as session:
+                async for output in self._apost_with(session, url, pload, sse):
                     yield output
+        else:
+            async for output in self._apost_with(session, url, pload, sse):
+                yield output
+
+    @staticmethod
+    async def _apost_with(session, url: str, pload: Dict, sse: bool) -> AsyncIterator[Dict]:
+        """Post a request with an aiohttp session and yield the json
+        outputs."""
+        stream = pload.get('stream', False)
+        async with session.post(url, json=pload) as response:
+            if not stream:
+                yield json_loads(await response.read())
+                return
+            sse = sse and _is_sse(response)
+            async for chunk in response.content:
+                chunk = chunk.strip()
+                if not chunk:
+                    continue
+                if sse:
+                    if chunk == b'data: [DONE]':
+                        continue
+                    if chunk.startswith(b'data: '):
+                        chunk = chunk[6:]
+                yield json_loads(chunk)
+
+    async def achat_completions_v1(self, *args, **kwargs) -> AsyncIterator[Dict]:
+        """Async version of `chat_completions_v1`, takes the same arguments.
+
+        Yields:
+            json objects in openai formats
+        """
+        pload = self._bind_pload(self.chat_completions_v1, *args, **kwargs)
+        async for output in self._apost(self.chat_completions_v1_url, pload, sse=True):
+            yield output
+
+    async def achat_interactive_v1(self, *args, **kwargs) -> AsyncIterator[Dict]:
+        """Async version of `chat_interactive_v1`, takes the same arguments.
+
+        Yields:
+            json objects consist of text, tokens, input_tokens,
+                history_tokens, finish_reason
+        """
+        pload = self._bind_pload(self.chat_interactive_v1, *args, **kwargs)
+        async for output in self._apost(self.chat_intractive_v1_url, pload, sse=False):
+            yield output
+
+    async def acompletions_v1(self, *args, **kwargs) -> AsyncIterator[Dict]:
+        """Async version of `completions_v1`, takes the same arguments.
+
+        Yields:
+            json objects in openai formats
+        """
+        pload = self._bind_pload(self.completions_v1, *args, **kwargs)
+        async for output in self._apost(self.completions_v1_url, pload, sse=True):
+            yield output
+
+    async def aclose(self):
+        """Close the aiohttp session used by the async methods, it should be
+        awaited in the event loop of the first async call."""
+        if self._aiosession is not None:
+            await self._aiosession.close()
+            self._aiosession = None
+            self._aioloop = None
 
     def chat(self,
              prompt: str,
@@ -364,11 +598,8 @@ class APIClient:
                 If not specified with a value other than -1, using random value
                 directly.
         """
-        for out in self.chat_interactive_v1(prompt='',
-                                            session_id=session_id,
-                                            request_output_len=0,
-                                            interactive_mode=False):
-            pass
+        pload = dict(prompt='', session_id=session_id, request_output_len=0, interactive_mode=False, stream=False)
+        self._session.post(self.chat_intractive_v1_url, json=pload, stream=False)
 
 
 def input_prompt():
@@ -404,13 +635,12 @@ def get_streaming_response(prompt: str,
         'temperature': temperature
     }
     response = requests.post(api_url, headers=headers, json=pload, stream=stream)
-    for chunk in response.iter_lines(chunk_size=8192, decode_unicode=False, delimiter=b'\n'):
+    for chunk in _iter_lines(response):
         if chunk:
-            data = json_loads(chunk.decode('utf-8'))
-            output = data.pop('text', '')
-            tokens = data.pop('tokens', 0)
-            finish_reason = data.pop('finish_reason', None)
-            yield output, tokens, finish_reason
+            data = json_loads(chunk)
+            if not data:
+                continue
+            yield data.get('text', ''), data.get('tokens', 0), data.get('finish_reason', None)
 
 
 def main(api_server_url: str = 'http://0.0.0.0:23333', session_id: int = 0, api_key: Optional[str] = None):
@@ -113,6 +113,20 @@ def create_error_response(status: HTTPStatus, message: str, error_type='invalid_
                         status_code=status.value)
 
 
+def _accept_ndjson(raw_request: Optional[Request]) -> bool:
+    """Whether the client asks for newline delimited json instead of sse."""
+    if raw_request is None:
+        return False
+    return 'application/x-ndjson' in raw_request.headers.get('accept', '')
+
+
+def _stream_frame(data: str, ndjson: bool) -> str:
+    """Frame a streamed json object."""
+    if ndjson:
+        return f'{data}\n'
+    return f'data: {data}\n\n'
+
+
 async def check_request(request) -> Optional[JSONResponse]:
     """Check if a request is valid."""
     if hasattr(request, 'model') and request.model not in get_model_list():
@@ -421,6 +435,8 @@ async def chat_completions_v1(request: ChatCompletionRequest, raw_request: Reque
 
         return response_json
 
+    ndjson = _accept_ndjson(raw_request)
+
     async def completion_stream_generator() -> AsyncGenerator[str, None]:
         previous_text = ''
         current_text = ''
@@ -485,12 +501,14 @@ async def chat_completions_v1(request: ChatCompletionRequest, raw_request: Reque
                                                         finish_reason=res.finish_reason,
                                                         logprobs=logprobs,
                                                         usage=usage)
-            yield f'data: {response_json}\n\n'
-        yield 'data: [DONE]\n\n'
+            yield _stream_frame(response_json, ndjson)
+        if not ndjson:
+            yield 'data: [DONE]\n\n'
 
     # Streaming response
     if request.stream:
-        return StreamingResponse(completion_stream_generator(), media_type='text/event-stream')
+        media_type = 'application/x-ndjson' if ndjson else 'text/event-stream'
+        return StreamingResponse(completion_stream_generator(), media_type=media_type)
 
     # Non-streaming response
     final_logprobs = []
@@ -668,6 +686,8 @@ async def completions_v1(request: CompletionRequest, raw_request: Request = None
 
         return response_json
 
+    ndjson = _accept_ndjson(raw_request)
+
     async def completion_stream_generator() -> AsyncGenerator[str, None]:
         # First chunk with role
         for generator in generators:
@@ -696,12 +716,14 @@ async def completions_v1(request: CompletionRequest, raw_request: Request = None
                                                             finish_reason=res.finish_reason,
                                                             logprobs=logprobs,
                                                             usage=usage)
-                yield f'data: {response_json}\n\n'
-        yield 'data: [DONE]\n\n'
+                yield _stream_frame(response_json, ndjson)
+        if not ndjson:
+            yield 'data: [DONE]\n\n'
 
     # Streaming response
     if request.stream:
-        return StreamingResponse(completion_stream_generator(), media_type='text/event-stream')
+        media_type = 'application/x-ndjson' if ndjson else 'text/event-stream'
+        return StreamingResponse(completion_stream_generator(), media_type=media_type)
 
     # Non-streaming response
     usage = UsageInfo()
@@ -29,3 +29,11 @@ class TestSiluAndMul:
 
         out = silu_and_mul(x)
         torch.testing.assert_close(out, gt)
+
+    @pytest.mark.parametrize('seqlen', [256], indirect=True)
+    @pytest.mark.parametrize('feat_size', [768], indirect=True)
+    def test_silu_and_mul_leading_dims(self, x, gt):
+        from lmdeploy.pytorch.kernels.cuda.activation import silu_and_mul
+
+        out = silu_and_mul(x.unflatten(0, (4, -1)))
+        torch.testing.assert_close(out, gt.unflatten(0, (4, -1)))
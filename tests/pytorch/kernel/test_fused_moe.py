@@ -13,6 +13,41 @@ def _get_sorted_idx(topk_idx: torch.Tensor, num_experts: int):
     return sorted_ids, exp_tok_cnt
 
 
+class TestGetSortedIdx:
+
+    @pytest.fixture
+    def device(self):
+        yield torch.device('cuda')
+
+    @pytest.fixture
+    def num_experts(self, request):
+        yield request.param
+
+    @pytest.fixture
+    def M(self, request):
+        yield request.param
+
+    @pytest.fixture
+    def topk_idx(self, M, num_experts, device):
+        top_k = 6
+        router_weights = torch.rand(M, num_experts, device=device)
+        yield router_weights.topk(top_k, dim=-1)[1]
+
+    @pytest.mark.parametrize('M', [4, 300], indirect=True)
+    @pytest.mark.parametrize('num_experts', [8, 64, 256], indirect=True)
+    def test_get_sorted_idx(self, topk_idx, num_experts):
+        from lmdeploy.pytorch.kernels.cuda.fused_moe import _get_sorted_idx
+        sorted_idx, exp_start, exp_end = _get_sorted_idx(topk_idx, num_experts)
+
+        gt_sorted_idx = topk_idx.flatten().argsort(stable=True)
+        exp_range = torch.arange(0, num_experts, device=topk_idx.device)
+        gt_cnt = (topk_idx.flatten()[None, :] == exp_range[:, None]).sum(1)
+        gt_end = gt_cnt.cumsum(0)
+        torch.testing.assert_close(sorted_idx, gt_sorted_idx)
+        torch.testing.assert_close(exp_end, gt_end)
+        torch.testing.assert_close(exp_start, gt_end - gt_cnt)
+
+
 class TestFusedMoEKernelLauncher:
 
     @pytest.fixture
@@ -130,6 +165,31 @@ class TestFusedMoEKernelLauncher:
         )
         torch.testing.assert_close(C, gt)
 
+    @torch.inference_mode()
+    def test_launcher_reduce_topk(self, A, B, sorted_idx, exp_start, exp_end, weights, top_k, M, gt):
+        """N is not a multiple of BLOCK_SIZE_N, wrapped columns must not be
+        added twice."""
+        from lmdeploy.pytorch.kernels.cuda.fused_moe import fused_moe_kernel_launcher
+        N = 100
+        B = B[:, :N].contiguous()
+        C = A.new_zeros(M, N, dtype=torch.float32)
+
+        fused_moe_kernel_launcher(
+            A,
+            B,
+            C,
+            sorted_idx,
+            exp_start,
+            exp_end,
+            weights,
+            enable_weights=True,
+            top_k=top_k,
+            num_tokens=M,
+            reduce_topk=True,
+        )
+        gt = gt.unflatten(0, (M, top_k))[..., :N].float().sum(1)
+        torch.testing.assert_close(C, gt, atol=1e-3, rtol=1e-3)
+
 
 def _mlp_forward(hidden_states, gate_proj, up_proj, down_proj):
     gate = F.linear(hidden_states, gate_proj)
@@ -137,6 +197,26 @@ def _mlp_forward(hidden_states, gate_proj, up_proj, down_proj):
     return F.linear(F.silu(gate) * up, down_proj)
 
 
+def _moe_forward(hidden_states, w1, w2, topk_weights, topk_idx, renormalize, expert_offset=0):
+    """reference moe, only the experts in w1/w2 (starting from expert_offset)
+    contribute."""
+    if renormalize:
+        topk_weights = topk_weights / topk_weights.sum(dim=-1, keepdim=True)
+
+    seq_len = hidden_states.size(0)
+    out_size = w2.size(1)
+    output = hidden_states.new_zeros(seq_len, out_size)
+    num_experts = w1.size(0)
+    for eid in range(num_experts):
+        token_idx, k_idx = torch.where(topk_idx == eid + expert_offset)
+        gate_proj, up_proj = w1[eid].chunk(2, dim=0)
+        down_proj = w2[eid]
+        tmp_out = _mlp_forward(hidden_states[token_idx], gate_proj, up_proj, down_proj)
+        tmp_out = tmp_out * topk_weights[token_idx, k_idx, None]
+        output.index_add_(0, token_idx, tmp_out.to(output.dtype))
+    return output
+
+
 class TestFusedMoe:
 
     @pytest.fixture
@@ -152,8 +232,8 @@ class TestFusedMoe:
         yield 128
 
     @pytest.fixture
-    def seq_len(seq_len):
-        yield 128
+    def seq_len(self, request):
+        yield request.param
 
     @pytest.fixture
     def hidden_size(self):
@@ -168,8 +248,8 @@ class TestFusedMoe:
         yield 64
 
     @pytest.fixture
-    def top_k(self):
-        yield 6
+    def top_k(self, request):
+        yield request.param
 
     @pytest.fixture
     def renormalize(self):
@@ -209,30 +289,67 @@ class TestFusedMoe:
 
     @pytest.fixture
     def gt(self, hidden_states, w1, w2, topk_weights, topk_idx, renormalize):
-        if renormalize:
-            topk_weights = topk_weights / topk_weights.sum(dim=-1, keepdim=True)
-
-        seq_len = hidden_states.size(0)
-        out_size = w2.size(1)
-        output = hidden_states.new_zeros(seq_len, out_size)
-        num_experts = w1.size(0)
-        for eid in range(num_experts):
-            token_idx, k_idx = torch.where(topk_idx == eid)
-            gate_proj, up_proj = w1[eid].chunk(2, dim=0)
-            down_proj = w2[eid]
-            tmp_out = _mlp_forward(hidden_states[token_idx], gate_proj, up_proj, down_proj)
-            tmp_out = tmp_out * topk_weights[token_idx, k_idx, None]
-            output.index_add_(0, token_idx, tmp_out.to(output.dtype))
-        yield output
+        yield _moe_forward(hidden_states, w1, w2, topk_weights, topk_idx, renormalize)
+
+    @pytest.mark.parametrize('seq_len', [4, 128], indirect=True)
+    @pytest.mark.parametrize('top_k', [2, 6], indirect=True)
+    @pytest.mark.parametrize('deterministic', [False, True])
+    @torch.inference_mode()
+    def test_fused_moe(self, hidden_states, w1, w2, topk_weights, topk_idx, top_k, renormalize, deterministic, gt):
+        output = fused_moe(hidden_states,
+                           w1,
+                           w2,
+                           topk_weights,
+                           topk_idx,
+                           topk=top_k,
+                           renormalize=renormalize,
+                           deterministic=deterministic)
+        torch.testing.assert_close(output, gt, atol=1e-3, rtol=1e-3)
+
+        if deterministic:
+            output2 = fused_moe(hidden_states,
+                                w1,
+                                w2,
+                                topk_weights,
+                                topk_idx,
+                                topk=top_k,
+                                renormalize=renormalize,
+                                deterministic=deterministic)
+            assert torch.equal(output, output2)
 
+    @pytest.mark.parametrize('seq_len', [4, 128], indirect=True)
+    @pytest.mark.parametrize('top_k', [2, 6], indirect=True)
     @torch.inference_mode()
-    def test_fused_moe(self, hidden_states, w1, w2, topk_weights, topk_idx, top_k, renormalize, gt):
-        output = fused_moe(hidden_states, w1, w2, topk_weights, topk_idx, topk=top_k, renormalize=renormalize)
+    def test_fused_moe_ep(self, hidden_states, w1, w2, topk_weights, topk_idx, top_k, num_experts, renormalize):
+        """only the local experts of an expert parallel rank contribute."""
+        expert_offset = 16
+        num_local_experts = 16
+        local_w1 = w1[expert_offset:expert_offset + num_local_experts]
+        local_w2 = w2[expert_offset:expert_offset + num_local_experts]
+        gt = _moe_forward(hidden_states, local_w1, local_w2, topk_weights, topk_idx, renormalize, expert_offset)
+
+        output = fused_moe(hidden_states,
+                           local_w1,
+                           local_w2,
+                           topk_weights,
+                           topk_idx,
+                           topk=top_k,
+                           expert_offset=expert_offset,
+                           num_experts=num_experts,
+                           renormalize=renormalize)
         torch.testing.assert_close(output, gt, atol=1e-3, rtol=1e-3)
 
 
 class TestFusedMoeW8A8(TestFusedMoe):
 
+    @pytest.fixture
+    def seq_len(self):
+        yield 128
+
+    @pytest.fixture
+    def top_k(self):
+        yield 6
+
     @pytest.fixture
     def quant_states(self, hidden_states):
         from lmdeploy.pytorch.kernels.cuda.w8a8_triton_kernels import per_token_quant_int8
@@ -277,3 +394,30 @@ class TestFusedMoeW8A8(TestFusedMoe):
                                 out_dtype=torch.float16,
                                 renormalize=renormalize)
         torch.testing.assert_close(output, gt, atol=5e-3, rtol=1e-3)
+
+    @torch.inference_mode()
+    def test_fused_moe_ep(self, hidden_states, w1, w2, quant_states, quant_w1, quant_w2, topk_weights, topk_idx, top_k,
+                          num_experts, renormalize):
+        from lmdeploy.pytorch.kernels.cuda.w8a8_fused_moe import fused_moe_w8a8
+        state_i8, state_scale = quant_states
+        w1_i8, w1_scale = quant_w1
+        w2_i8, w2_scale = quant_w2
+        expert_offset = 16
+        num_local_experts = 16
+        local = slice(expert_offset, expert_offset + num_local_experts)
+        gt = _moe_forward(hidden_states, w1[local], w2[local], topk_weights, topk_idx, renormalize, expert_offset)
+
+        output = fused_moe_w8a8(state_i8,
+                                state_scale,
+                                w1_i8[local],
+                                w1_scale[local],
+                                w2_i8[local],
+                                w2_scale[local],
+                                topk_weights=topk_weights,
+                                topk_ids=topk_idx,
+                                topk=top_k,
+                                out_dtype=torch.float16,
+                                expert_offset=expert_offset,
+                                num_experts=num_experts,
+                                renormalize=renormalize)
+        torch.testing.assert_close(output, gt, atol=5e-3, rtol=1e-3)
@@ -0,0 +1,270 @@
+import asyncio
+import json
+
+import pytest
+
+from lmdeploy.serve.openai.api_client import APIClient, _get_signature, _iter_lines
+
+API_SERVER_URL = 'http://0.0.0.0:23333'
+
+
+class FakeAioContent:
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def __aiter__(self):
+        return self._iter()
+
+    async def _iter(self):
+        for line in self.lines:
+            yield line
+
+
+class FakeAioResponse:
+
+    def __init__(self, lines, content_type):
+        self.headers = {'content-type': content_type}
+        self.content = FakeAioContent(lines)
+
+    async def read(self):
+        return b''.join(self.content.lines)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeAioSession:
+    """Record the posted requests and answer with the queued responses."""
+
+    responses = []
+    requests = []
+    instances = []
+
+    def __init__(self, headers=None):
+        self.headers = headers
+        self.closed = False
+        self.instances.append(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def post(self, url, json=None):
+        self.requests.append((url, json))
+        return self.responses.pop(0)
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def client():
+    yield APIClient(API_SERVER_URL)
+
+
+@pytest.fixture
+def aiosession(monkeypatch):
+    aiohttp = pytest.importorskip('aiohttp')
+    monkeypatch.setattr(aiohttp, 'ClientSession', FakeAioSession)
+    FakeAioSession.responses = []
+    FakeAioSession.requests = []
+    FakeAioSession.instances = []
+    yield FakeAioSession
+
+
+class FakeResponse:
+
+    def __init__(self, content=b'', content_type='application/json', status_code=200, chunks=None):
+        self.content = content
+        self.headers = {'content-type': content_type}
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.chunks = chunks
+
+    def iter_content(self, chunk_size=1):
+        if self.chunks is not None:
+            yield from self.chunks
+            return
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+
+async def _collect(agen):
+    return [output async for output in agen]
+
+
+def test_bind_pload(client):
+    pload = client._bind_pload(client.completions_v1, 'internlm', 'hello', temperature=0.5, session_id=3)
+    # extra kwargs are flattened into the request body
+    assert 'kwargs' not in pload
+    assert 'self' not in pload
+    assert pload['model'] == 'internlm'
+    assert pload['prompt'] == 'hello'
+    assert pload['temperature'] == 0.5
+    assert pload['session_id'] == 3
+    # defaults of the sync method are sent as well
+    assert pload['stream'] is False
+    assert pload['max_tokens'] == 16
+
+    pload = client._bind_pload(client.chat_interactive_v1, prompt='hi', stream=True)
+    assert 'kwargs' not in pload
+    assert pload['prompt'] == 'hi'
+    assert pload['stream'] is True
+    assert pload['session_id'] == -1
+
+    # signatures are inspected once per method
+    hits = _get_signature.cache_info().hits
+    client._bind_pload(client.chat_interactive_v1, prompt='hi')
+    assert _get_signature.cache_info().hits == hits + 1
+
+
+def test_acompletions_v1(client, aiosession):
+    aiosession.responses = [
+        FakeAioResponse([b'data: {"id": 0}\n', b'\n', b'data: {"id": 1}\n', b'\n', b'data: [DONE]\n', b'\n'],
+                        'text/event-stream'),
+        FakeAioResponse([b'{"id": 2}'], 'application/json'),
+    ]
+    outputs = asyncio.run(_collect(client.acompletions_v1('internlm', 'hello', stream=True)))
+    assert outputs == [{'id': 0}, {'id': 1}]
+    url, pload = aiosession.requests[0]
+    assert url == client.completions_v1_url
+    assert pload['prompt'] == 'hello'
+    assert pload['stream'] is True
+
+    # the shared session belongs to the previous event loop, this one posts with a session of its own
+    session = client._aiosession
+    outputs = asyncio.run(_collect(client.acompletions_v1('internlm', 'hello')))
+    assert outputs == [{'id': 2}]
+    assert client._aiosession is session
+    assert len(aiosession.instances) == 2
+    assert aiosession.instances[1].closed
+    assert not session.closed
+
+
+def test_achat_completions_v1_ndjson(client, aiosession):
+    aiosession.responses = [FakeAioResponse([b'{"id": 0}\n', b'{"id": 1}\n'], 'application/x-ndjson')]
+    messages = [dict(role='user', content='hello')]
+    outputs = asyncio.run(_collect(client.achat_completions_v1('internlm', messages, stream=True, top_k=4)))
+    assert outputs == [{'id': 0}, {'id': 1}]
+    url, pload = aiosession.requests[0]
+    assert url == client.chat_completions_v1_url
+    assert pload['messages'] == messages
+    assert pload['top_k'] == 4
+
+
+def test_achat_interactive_v1(client, aiosession):
+    aiosession.responses = [FakeAioResponse([b'{"text": "a"}\n', b'{"text": "b"}\n'], 'application/x-ndjson')]
+
+    async def _run():
+        outputs = await _collect(client.achat_interactive_v1('hello', session_id=1, stream=True))
+        session = client._aiosession
+        await client.aclose()
+        return outputs, session
+
+    outputs, session = asyncio.run(_run())
+    assert outputs == [{'text': 'a'}, {'text': 'b'}]
+    assert session.closed
+    assert client._aiosession is None
+    url, pload = aiosession.requests[0]
+    assert url == client.chat_intractive_v1_url
+    assert pload['session_id'] == 1
+
+
+def test_available_models(client, monkeypatch):
+    responses = [
+        FakeResponse(status_code=503),
+        FakeResponse(b'{"data": [{"id": "internlm"}]}'),
+    ]
+    monkeypatch.setattr(client._session, 'get', lambda url, headers=None: responses.pop(0))
+    # a failed lookup is not cached
+    assert client.available_models is None
+    assert client.available_models == ['internlm']
+    # the model list is only fetched once
+    assert client.available_models == ['internlm']
+    assert len(responses) == 0
+
+
+class FakeRequest:
+
+    def __init__(self, accept=None):
+        self.headers = {} if accept is None else {'accept': accept}
+
+
+def test_iter_lines():
+    # frames split across reads, an empty line and a trailing partial line
+    response = FakeResponse(chunks=[b'{"id"', b': 0}\n{"i', b'd": 1}\n', b'\n', b'{"id": 2}'])
+    assert list(_iter_lines(response)) == [b'{"id": 0}', b'{"id": 1}', b'', b'{"id": 2}']
+
+    response = FakeResponse(b'data: {"id": 0}\n\ndata: [DONE]\n\n')
+    assert list(_iter_lines(response, chunk_size=3)) == [b'data: {"id": 0}', b'', b'data: [DONE]', b'']
+
+    assert list(_iter_lines(FakeResponse(b''))) == []
+
+
+@pytest.mark.parametrize('content_type,content', [
+    ('application/x-ndjson', b'{"id": 0}\n{"id": 1}\n'),
+    ('text/event-stream', b'data: {"id": 0}\n\ndata: {"id": 1}\n\ndata: [DONE]\n\n'),
+    ('text/event-stream; charset=utf-8', b'data: {"id": 0}\n\ndata: {"id": 1}\n\ndata: [DONE]\n\n'),
+])
+def test_completions_v1_stream(client, monkeypatch, content_type, content):
+    """The client parses ndjson and falls back to sse for servers without
+    ndjson support."""
+    assert 'application/x-ndjson' in client.headers['accept']
+    response = FakeResponse(content, content_type)
+    monkeypatch.setattr(client._session, 'post', lambda url, json=None, stream=False: response)
+    outputs = list(client.completions_v1('internlm', 'hello', stream=True))
+    assert outputs == [{'id': 0}, {'id': 1}]
+
+
+def test_stream_framing(client, monkeypatch):
+    api_server = pytest.importorskip('lmdeploy.serve.openai.api_server')
+    assert api_server._accept_ndjson(FakeRequest(client.headers['accept']))
+    assert not api_server._accept_ndjson(FakeRequest('text/event-stream'))
+    assert not api_server._accept_ndjson(FakeRequest())
+    assert not api_server._accept_ndjson(None)
+
+    data = [dict(id=0, text='a\nb'), dict(id=1, text='')]
+    for ndjson in [True, False]:
+        body = ''.join(api_server._stream_frame(json.dumps(item), ndjson) for item in data)
+        if ndjson:
+            assert body == '{"id": 0, "text": "a\\nb"}\n{"id": 1, "text": ""}\n'
+            content_type = 'application/x-ndjson'
+        else:
+            body += 'data: [DONE]\n\n'
+            assert body.startswith('data: {"id": 0')
+            content_type = 'text/event-stream'
+        response = FakeResponse(body.encode(), content_type)
+        monkeypatch.setattr(client._session, 'post', lambda url, json=None, stream=False: response)
+        assert list(client.chat_completions_v1('internlm', 'hello', stream=True)) == data
+
+
+def test_encode_many(client, monkeypatch):
+    posts = []
+
+    def _post(url, json=None, stream=False):
+        posts.append((url, json))
+        return responses.pop(0)
+
+    responses = [
+        FakeResponse(b'{"input_ids": [[1, 2], [1, 3, 4]], "length": [2, 3]}'),
+        FakeResponse(status_code=500),
+    ]
+    monkeypatch.setattr(client._session, 'post', _post)
+    # a batch is encoded with a single request
+    assert client.encode_many(('hi', 'hello')) == [([1, 2], 2), ([1, 3, 4], 3)]
+    assert len(posts) == 1
+    url, pload = posts[0]
+    assert url == client.encode_v1_url
+    assert pload['input'] == ['hi', 'hello']
+
+    assert client.encode_many(['hi', 'hello']) == [(None, None)] * 2
+    assert len(posts) == 2
+
+    assert client.encode_many([]) == []
+    assert len(posts) == 2